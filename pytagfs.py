@@ -6,6 +6,11 @@ import errno
 import time
 import logging
 import sqlite3
+import operator
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from collections import namedtuple
 
 
 from fuse import FUSE, FuseOSError, Operations
@@ -14,23 +19,92 @@ import stat
 from optparse import OptionParser
 
 ## constants and helpers
+# how long metadata changes may wait before they are committed together
+COMMIT_DELAY = 0.2
+# and the most changes that may share one commit
+COMMIT_BATCH = 1000
+# one row per tag of the named file, or a single NULL tag if it has none
+FILE_TAGS_QUERY = """SELECT tags.name
+FROM files
+LEFT JOIN file_tags ON files.id = file_tags.file_id
+LEFT JOIN tags ON tags.id = file_tags.tag_id
+WHERE files.name = ?"""
+
+# the kernel hands us the same few paths over and over, and these only
+# depend on the path string, so they are memoized.  They return tuples so
+# that a cached result can't be changed by a caller.
+PATH_CACHE_SIZE = 4096
+# mount options used unless overridden with -o.  Files are plain files in
+# the store, so let the kernel move data in large requests instead of 4k
+# pages (libfuse 2 caps these at 128k), keep file pages cached across opens
+# while the mtime holds, and trust attributes for a few seconds since they
+# only change through this mount.  Entries keep the 1s default: a tagging
+# change can flip other names between hidden and shown, and fusepy has no
+# way to notify the kernel about that.
+DEFAULT_FUSE_OPTIONS = {'big_writes': True, 'max_write': 131072, 'max_read': 131072,
+                        'auto_cache': True, 'attr_timeout': 5}
+# how long getattr may reuse a file's stat, which covers the burst of calls
+# for one file that path walks and ls -l make
+STAT_TTL = 0.05
+# the stat fields reported by getattr
+STAT_KEYS = ('st_atime', 'st_ctime', 'st_gid', 'st_mode',
+             'st_mtime', 'st_nlink', 'st_size', 'st_uid')
+stat_values = operator.attrgetter(*STAT_KEYS)
+# the attributes readdir reports for each kind of entry.  Only the type is
+# used, for d_type, which spares ls and find a getattr just to learn it.
+ENTRY_ATTRS = {fmt: {'st_mode': fmt} for fmt in (stat.S_IFDIR, stat.S_IFREG, stat.S_IFLNK,
+                                                 stat.S_IFIFO, stat.S_IFSOCK, stat.S_IFCHR,
+                                                 stat.S_IFBLK)}
+# syncs a file's data without forcing out unrelated metadata like its times,
+# where the platform can
+sync_data = getattr(os, 'fdatasync', os.fsync)
+# counts the set bits of a tag bitmap; int.bit_count is new in Python 3.10
+bit_count = getattr(int, 'bit_count', lambda b: bin(b).count('1'))
+
+FilePath = namedtuple('FilePath', ['tags', 'name'])
+
+@lru_cache(maxsize=PATH_CACHE_SIZE)
+def parse_file_path(path):
+    '''Splits a file path into its tags and its name in one pass.
+    Leading dots only mark a name hidden, so they are dropped, but trailing
+    dots belong to the name.'''
+    head, _, tail = path.rpartition('/')
+    if len(head) < 2:
+        return FilePath((), tail.lstrip('.'))
+    return FilePath(tuple(t.lstrip('.') for t in head.strip('/').split('/')), tail.lstrip('.'))
+
+@lru_cache(maxsize=PATH_CACHE_SIZE)
 def dir_tags(path):
-    if len(path) < 2:
-        return []
-    return [t.lstrip('.') for t in path.strip('/').split('/')]
+    # getattr and access parse a path as a file before trying it as a
+    # directory, so reuse that split and only add the last component
+    tags = parse_file_path(path).tags
+    last = path.rpartition('/')[2].lstrip('.')
+    return tags + (last,) if last else tags
 
 def file_tags(path):
-    path = path[:path.rindex('/')]
-    if len(path) < 2:
-        return []
-    return [t.lstrip('.') for t in path.strip('/').split('/')]
+    return parse_file_path(path).tags
 
 def file_name(path):
-    return path.split('/')[-1].strip('.')
+    return parse_file_path(path).name
+
+# statements that take one parameter per tag are built once for each tag
+# count, so sqlite's statement cache sees the same text again
+@lru_cache(maxsize=32)
+def add_tags_sql(n):
+    return "INSERT OR IGNORE INTO file_tags (file_id, tag_id) VALUES " + ', '.join(["(?, ?)"]*n)
+
+@lru_cache(maxsize=32)
+def keep_tags_sql(n):
+    return ("DELETE FROM file_tags WHERE file_id = ? AND tag_id NOT IN (" +
+            ', '.join(["?"]*n) + ")")
+
+@lru_cache(maxsize=PATH_CACHE_SIZE)
+def store_file(store_prefix, tag_path):
+    return store_prefix + parse_file_path(tag_path).name
 
 class Tagfs(Operations):
     def __init__(self, root, mount, flat_delete, hidden_limit):
-        logging.info("init on "+ root)
+        logging.info("init on %s", root)
         self.root = root
         self.mount = mount
         self.hidden_limit = hidden_limit
@@ -38,10 +112,33 @@ class Tagfs(Operations):
         self.store = os.path.join(self.root, 'store')
         # check to make sure we have a valid store structure
         if not os.path.exists(self.store):
-            logging.info("Could not find actual store directory. Creating directory " + self.store)
+            logging.info("Could not find actual store directory. Creating directory %s", self.store)
             os.mkdir(self.store)
-        self.con = sqlite3.connect(os.path.join(self.root, '.sqlite'))
-        logging.debug("table_exists: " + str(self.con.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()))
+        # store paths are built by concatenation, so keep the separator on
+        self._store_prefix = os.path.join(self.store, '')
+        # transactions are managed by hand in _transaction, and committed from
+        # a timer thread, so the connection has to be shareable
+        self.con = sqlite3.connect(os.path.join(self.root, '.sqlite'),
+                                   isolation_level=None, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._commit_timer = None
+        self._pending = 0
+        self._depth = 0
+        # tag directories all report the store directory's stat, which only
+        # changes when files come and go, so it is cached until a mutation
+        self._store_attrs = None
+        # with WAL, synchronous=NORMAL can only lose the latest commits on
+        # power loss, and only pays for an fsync at checkpoints
+        self.con.execute("PRAGMA synchronous = NORMAL")
+        self.con.execute("PRAGMA busy_timeout = 5000")
+        self.con.execute("PRAGMA temp_store = MEMORY")
+        # keep up to ~20MB of pages, so rebuilding the tag bitmaps after a
+        # change mostly reads file_tags pages sqlite already holds
+        self.con.execute("PRAGMA cache_size = -20000")
+        # and read the database through a memory map instead of read() calls
+        self.con.execute("PRAGMA mmap_size = 268435456")
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("table_exists: %s", self.con.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall())
         with self.con as c:
             c.execute("PRAGMA journal_mode = WAL")
             c.execute("""CREATE TABLE IF NOT EXISTS files (
@@ -69,249 +166,419 @@ class Tagfs(Operations):
             FROM tags
             INNER JOIN file_tags ON tags.id = file_tags.tag_id
             INNER JOIN files ON files.id = file_tags.file_id""")
+            # reverse index for looking up the files under a tag
+            c.execute("CREATE INDEX IF NOT EXISTS file_tags_by_tag ON file_tags (tag_id, file_id)")
                 
-        logging.debug(self._tags())
-        pass
-
-    def _tags(self):
-        return [x[0] for x in self.con.execute("SELECT name FROM tags").fetchall()]
-    
+        # tag names are consulted on nearly every call, so keep them in memory,
+        # along with the ids that readdir binds into its queries
+        self._tag_ids = dict(self.con.execute("SELECT name, id FROM tags").fetchall())
+        logging.debug(self._tag_ids)
+        # as are file names, which getattr and access check on every call
+        self._file_names = set(self._files())
+        # and the types of the few store files that aren't regular files, so
+        # readdir can report every entry's type without a stat per entry
+        self._file_types = {}
+        with os.scandir(self.store) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    self._file_types[entry.name] = stat.S_IFMT(entry.stat(follow_symlinks=False).st_mode)
+        # tags of recently looked up files, dropped whenever metadata changes
+        self._file_tags_cache = {}
+        # file names and taggings by id for readdir, likewise dropped on
+        # changes, and the tag bitmaps built from them for tagged paths
+        self._index = None
+        self._bitmaps = None
+        # and finished listings by path, so repeated ls of a tag is a lookup
+        self._listings = {}
+        # recent file stats by store path, as (time taken, attributes).  Writes
+        # invalidate entries without taking the metadata lock, so the cache
+        # has its own, and a count of invalidations so far.
+        self._stat_cache = {}
+        self._stat_lock = threading.Lock()
+        self._stat_generation = 0
+
+    @contextmanager
+    def _transaction(self):
+        '''Runs a metadata change in a savepoint of the pending transaction.
+        A failed change is rolled back on its own, and the transaction is
+        committed after COMMIT_DELAY so bursts of changes share one commit.'''
+        with self._lock:
+            if not self.con.in_transaction:
+                self.con.execute("BEGIN")
+            self.con.execute("SAVEPOINT op")
+            self._depth += 1
+            try:
+                yield self.con
+            except BaseException:
+                self.con.execute("ROLLBACK TO op")
+                self.con.execute("RELEASE op")
+                if self._depth == 1 and self._pending == 0:
+                    # nothing else is waiting to be committed, and no timer
+                    # will end the transaction, so end it here rather than
+                    # hold the write lock until some later change commits
+                    self.con.execute("ROLLBACK")
+                raise
+            finally:
+                self._depth -= 1
+                self._file_tags_cache.clear()
+                self._index = None
+                self._bitmaps = None
+                self._listings.clear()
+            self.con.execute("RELEASE op")
+            self._store_attrs = None
+            if self._depth:
+                # nested in another change, which will commit for both
+                return
+            self._pending += 1
+            if self._pending >= COMMIT_BATCH:
+                self._commit()
+            elif self._commit_timer is None:
+                self._commit_timer = threading.Timer(COMMIT_DELAY, self._commit)
+                self._commit_timer.daemon = True
+                self._commit_timer.start()
+
+    def _commit(self):
+        with self._lock:
+            if self._commit_timer is not None:
+                self._commit_timer.cancel()
+                self._commit_timer = None
+            if self.con.in_transaction:
+                logging.debug("committing %d metadata changes", self._pending)
+                self.con.execute("COMMIT")
+            self._pending = 0
 
     def _files(self):
         return [x[0] for x in self.con.execute("SELECT name FROM files").fetchall()]
 
+    def _file_tags(self, name):
+        '''Returns the set of tags on a file, or None if there is no such file.'''
+        # hits skip the lock, so getattr doesn't queue behind a listing or a
+        # change.  Entries are only added, and cleared, while holding it.
+        true_tags = self._file_tags_cache.get(name, False)
+        if true_tags is not False:
+            return true_tags
+        with self._lock:
+            if name in self._file_tags_cache:
+                return self._file_tags_cache[name]
+            rows = self.con.execute(FILE_TAGS_QUERY, (name,)).fetchall()
+            true_tags = frozenset(x[0] for x in rows if x[0] is not None) if rows else None
+            if len(self._file_tags_cache) >= PATH_CACHE_SIZE:
+                self._file_tags_cache.clear()
+            self._file_tags_cache[name] = true_tags
+        return true_tags
+
+    def _file_index(self):
+        '''Returns the file names by id, and the tag ids of each tagged file
+        id.  Built on first use after a change.'''
+        with self._lock:
+            if self._index is None:
+                names = dict(self.con.execute("SELECT id, name FROM files").fetchall())
+                tagged = {}
+                for file_id, tag_id in self.con.execute("SELECT file_id, tag_id FROM file_tags"):
+                    if file_id in names:
+                        tagged.setdefault(file_id, []).append(tag_id)
+                self._index = (names, tagged)
+            return self._index
+
+    def _tag_bitmaps(self):
+        '''Returns the members of each tag id as an int with bit file_id set,
+        along with the file index they were built from.
+        Built on first use after a change.'''
+        # these are rebuilt whole rather than patched per change.  Changes
+        # come in bursts (a copy, a batch of moves) that share one rebuild at
+        # the next tagged listing, it is one pass over the file index, and
+        # keeping them in step would put that cost on every change instead.
+        # Each bitmap is only as wide as its tag's highest file id, so a tag
+        # costs at most that id / 8 bytes, and tags on a few old files stay
+        # small however many files come after them.
+        with self._lock:
+            if self._bitmaps is None:
+                names, tagged = self._file_index()
+                members = {}
+                for file_id, tag_ids in tagged.items():
+                    for tag_id in tag_ids:
+                        members.setdefault(tag_id, []).append(file_id)
+                bits = {}
+                for tag_id, file_ids in members.items():
+                    b = bytearray(max(file_ids) // 8 + 1)
+                    for file_id in file_ids:
+                        b[file_id >> 3] |= 1 << (file_id & 7)
+                    bits[tag_id] = int.from_bytes(b, 'little')
+                self._bitmaps = (bits, names, tagged)
+            return self._bitmaps
+
+    def _tag_rows(self, file_id, tags):
+        '''Returns the file_tags rows tagging file_id with tags, resolving the
+        tag ids from memory.  Every tag has to exist.'''
+        try:
+            return [(file_id, self._tag_ids[tag]) for tag in tags]
+        except KeyError:
+            raise FuseOSError(errno.ENOENT)
+
+    def _add_tags(self, c, file_id, tags):
+        '''Tags file_id with all of tags in a single statement.'''
+        rows = self._tag_rows(file_id, tags)
+        if rows:
+            c.execute(add_tags_sql(len(rows)), [v for row in rows for v in row])
+
+    def _file_entry(self, name, hidden):
+        attrs = ENTRY_ATTRS[self._file_types.get(name, stat.S_IFREG)]
+        return ('.' + name if hidden else name, attrs, 0)
+
     def _consistent_file_path(self, path):
-        name = file_name(path)
-        tags = file_tags(path)
-        if self.con.execute("SELECT 1 FROM files WHERE name = ?", (name,)).fetchone() is None:
+        tags, name = parse_file_path(path)
+        true_tags = self._file_tags(name)
+        if true_tags is None:
             return False
-        true_tags = [x[0] for x in self.con.execute("SELECT tag FROM taggings WHERE file = ?", (name,)).fetchall()]
-        logging.debug("true tags: " + str(true_tags) +
-                      " given tags: " + str(tags))
+        logging.debug("true tags: %s given tags: %s", true_tags, tags)
         if path[path.rindex('/')+1] != '.':
-            return set(true_tags) == set(tags)
-        return set(tags) < set(true_tags)
+            return true_tags == set(tags)
+        return set(tags) < true_tags
 
     def _store_path(self, tag_path):
-        return os.path.join(self.store, tag_path.split('/')[-1].lstrip('.'))
+        return store_file(self._store_prefix, tag_path)
+
+    def _file_attrs(self, store_path):
+        now = time.monotonic()
+        cached = self._stat_cache.get(store_path)
+        if cached is not None and now - cached[0] < STAT_TTL:
+            return cached[1]
+        # a stat taken while some file changed may already be stale, so it is
+        # only kept if nothing was invalidated since it started
+        generation = self._stat_generation
+        attrs = dict(zip(STAT_KEYS, stat_values(os.lstat(store_path))))
+        with self._stat_lock:
+            if generation == self._stat_generation:
+                if len(self._stat_cache) >= PATH_CACHE_SIZE:
+                    self._stat_cache.clear()
+                self._stat_cache[store_path] = (now, attrs)
+        return attrs
+
+    def _forget_attrs(self, store_path):
+        with self._stat_lock:
+            self._stat_generation += 1
+            self._stat_cache.pop(store_path, None)
 
     def getxattr(self, path, name, *args):
-        logging.info("API: getxattr " + path + ", " + str(name) + ", " +str(args))
-        if path == '/' or path.split('/')[-1].strip('.') in self._tags():
-            if set(dir_tags(path)).issubset(set(self._tags())):
+        logging.info("API: getxattr %s, %s, %s", path, name, args)
+        if path == '/' or file_name(path) in self._tag_ids:
+            if set(dir_tags(path)) <= self._tag_ids.keys():
                 return os.getxattr(self.store, name, *args)
             else:
                 raise FuseOSError(errno.ENOENT)
         if not self._consistent_file_path(path):
-            logging.debug(path + " deemed inconsistent")
+            logging.debug("%s deemed inconsistent", path)
             raise FuseOSError(errno.ENOENT)
         return os.getxattr(self._store_path(path), name, *args)
 
     def access(self, path, mode):
         # check if this is a directory
-        logging.info("API: access " + path + " " + oct(mode))
+        logging.info("API: access %s %o", path, mode)
         store_path = self._store_path(path)
-        logging.debug("store path: " + store_path)
-        if path[-1] == '/' or file_name(path) not in self._files():
-            for tag in dir_tags(path):
-                if tag not in self._tags():
-                    raise FuseOSError(errno.ENOENT)
+        logging.debug("store path: %s", store_path)
+        if path[-1] == '/' or file_name(path) not in self._file_names:
+            if not set(dir_tags(path)) <= self._tag_ids.keys():
+                raise FuseOSError(errno.ENOENT)
             if not os.access(self.store, mode):
                 raise FuseOSError(errno.EACCES)
         else:
-            if not os.access(self._store_path(path), mode):
+            if not os.access(store_path, mode):
                 raise FuseOSError(errno.EACCES)
-        logging.debug("Permission granted: " + path + " " + oct(mode))
+        logging.debug("Permission granted: %s %o", path, mode)
 
     def chmod(self, path, mode):
         logging.info("API: chmod")
-        return os.chmod(self._store_path(path), mode)
+        store_path = self._store_path(path)
+        try:
+            return os.chmod(store_path, mode)
+        finally:
+            self._forget_attrs(store_path)
 
     def chown(self, path, uid, gid):
         logging.info("API: chown")
-        return os.chown(self._store_path(path), uid, gid)
+        store_path = self._store_path(path)
+        try:
+            return os.chown(store_path, uid, gid)
+        finally:
+            self._forget_attrs(store_path)
 
     def getattr(self, path, fh=None):
-        logging.info("API: getattr " + path)
+        logging.info("API: getattr %s", path)
         if path == "/..deleteme":
             raise FuseOSError(errno.ENOENT)
         perm = 0o777
         # we're going to lie about the number of hardlinks we have to path (st_nlinks). 
         # internally, we should be able to get away with it because deleting tags should never delete media.
 
-        full_path = self._store_path(path)
-        if path[-1] == '/' or file_name(path) not in self._files():
+        if path[-1] == '/' or file_name(path) not in self._file_names:
             # we (may) have a directory
-            for tag in dir_tags(path):
-                if tag not in self._tags():
-                    logging.debug(tag + " not in " + str(self._tags()))
-                    raise FuseOSError(errno.ENOENT)
-            st = os.lstat(self.store)
-            return {key: getattr(st, key) for key in
-                    ('st_atime', 'st_ctime', 'st_gid', 'st_mode',
-                     'st_mtime', 'st_nlink', 'st_size', 'st_uid')}
-
-        st = os.lstat(full_path)
+            if not set(dir_tags(path)) <= self._tag_ids.keys():
+                logging.debug("%s names a missing tag", path)
+                raise FuseOSError(errno.ENOENT)
+            attrs = self._store_attrs
+            if attrs is None:
+                # changes reset the cached stat under the lock, so take it
+                # there too, or a reset could land between the lstat and
+                # storing its now stale result
+                with self._lock:
+                    if self._store_attrs is None:
+                        self._store_attrs = dict(zip(STAT_KEYS, stat_values(os.lstat(self.store))))
+                    attrs = self._store_attrs
+            return attrs
+
+        attrs = self._file_attrs(self._store_path(path))
         if not self._consistent_file_path(path):
-            logging.debug(path + " deemed inconsistent")
+            logging.debug("%s deemed inconsistent", path)
             raise FuseOSError(errno.ENOENT)
-        return {key: getattr(st, key) for key in
-                ('st_atime', 'st_ctime', 'st_gid', 'st_mode',
-                 'st_mtime', 'st_nlink', 'st_size', 'st_uid')}
+        return attrs
 
     def readdir(self, path, fh):
-        '''Implements directory listing as a generator.
+        '''Implements directory listing, returned as a list.
         The path is just split into tags.  No tag may be a filename.
         Items matching all tags are listed.  Those which are additionally
         members of other tags are hidden.  Existing tags will be shown if they
         contain some of those hidden members, otherwise hidden.'''
-        logging.info("API: readdir " + path)
-        tags = dir_tags(path)
-        true_tags = self._tags()
-        for tag in tags:
-            if tag not in true_tags:
-                raise FuseOSError(errno.ENOENT)
+        logging.info("API: readdir %s", path)
+        # like cached file tags, a listing is only stored under the lock and
+        # is dropped by the next change
+        dirents = self._listings.get(path)
+        if dirents is not None:
+            return dirents
+        tags = list(dir_tags(path))
         tset = set(tags)
-        dirents = ['.', '..']
-        if len(tags) == 0:
-            dirents.extend(self._tags())
-            if self.hidden_limit == -1:
-                logging.debug("No hidden limit.")
-                file_ents = self.con.execute("""SELECT CASE
-                WHEN tag_id IS NULL THEN name
-                ELSE '.' ||  name END
-                FROM files LEFT JOIN file_tags ON files.id = file_tags.file_id
-                """).fetchall()
+        dir_attrs = ENTRY_ATTRS[stat.S_IFDIR]
+        dirents = [('.', dir_attrs, 0), ('..', dir_attrs, 0)]
+        # the listing reads several queries and the tag dict, so keep
+        # mutations from landing halfway through it
+        with self._lock:
+            if not tset <= self._tag_ids.keys():
+                raise FuseOSError(errno.ENOENT)
+            if len(tags) == 0:
+                dirents.extend((tag, dir_attrs, 0) for tag in self._tag_ids)
+                # files with any tag are hidden, read from the cached file
+                # index instead of probing file_tags for every file.  The
+                # root needs no bitmaps, so they aren't built for it.
+                names, tagged = self._file_index()
+                if self.hidden_limit == -1:
+                    logging.debug("No hidden limit.")
+                    dirents.extend(self._file_entry(name, i in tagged)
+                                   for i, name in names.items())
+                else:
+                    logging.debug("Hidden limit: %d", self.hidden_limit)
+                    # only the hidden (tagged) files count towards the limit
+                    hidden = []
+                    for i, name in names.items():
+                        if i not in tagged:
+                            dirents.append(self._file_entry(name, False))
+                        elif len(hidden) < self.hidden_limit:
+                            hidden.append(self._file_entry(name, True))
+                    dirents.extend(hidden)
             else:
-                logging.debug("Hidden limit: " + str(self.hidden_limit))
-                file_ents = self.con.execute("""SELECT name
-                FROM files LEFT JOIN file_tags ON files.id = file_tags.file_id
-                WHERE tag_id IS NULL
-                UNION
-                SELECT '.' || name FROM 
-                files LEFT JOIN file_tags ON files.id = file_tags.file_id
-                WHERE tag_id IS NOT NULL
-                LIMIT ?""", (self.hidden_limit,))
-            logging.debug("file ents: " + str(file_ents))
-            dirents.extend([x[0] for x in file_ents])
-        else:
-            file_select = """(
-SELECT path_tag_count.file AS file, other_tags.tag AS tag
-FROM ( SELECT file, COUNT(tag) AS count
-       FROM taggings WHERE tag IN (""" + ', '.join(["?"]*len(tags)) + """ )
-       GROUP BY file
-     ) path_tag_count
-LEFT JOIN ( SELECT tag, file
-            FROM taggings
-            WHERE tag NOT IN (
-       """ + ', '.join(["?"]*len(tags)) + """ )
-          ) other_tags
-ON path_tag_count.file = other_tags.file
-WHERE path_tag_count.count = ? )""" # , tags + tags + [len(tags)])
-            
-
-            with self.con as c:
-                test_query = c.execute(file_select[1:-2],
-                                       tags + tags + [len(tags)]).fetchall()
-                logging.debug("test query: " + str(test_query))
-
-                file_ents = c.execute("""SELECT CASE
-                WHEN tag IS NULL THEN file
-                ELSE  '.' || file END
-                FROM ( SELECT file, tag FROM
-                """+ file_select + """
-                GROUP BY file) AS unique_files""",
-                                      tags + tags + [len(tags)]).fetchall()
-                logging.info("file ents: " + str(file_ents))
-                dirents.extend([x[0] for x in file_ents])
-                
-                tag_ents = c.execute("""SELECT CASE
-                WHEN file IS NULL THEN '.' || other_tags.tag
-                ELSE other_tags.tag END
-                FROM (SELECT name AS tag FROM tags WHERE name NOT IN (
-                """+ ', '.join(["?"]*len(tags)) + """ )) AS other_tags
-                LEFT JOIN ( SELECT tag, file FROM
-                """+ file_select +""" AS file_select
-                          GROUP BY tag) AS file_join
-                ON other_tags.tag = file_join.tag""", tags + tags + tags + [len(tags)]).fetchall()
-                logging.info("tag ents: " + str(tag_ents))
-                dirents.extend([x[0] for x in tag_ents])
-
-            
+                # each tag's members are a bitmap over file ids, so the matches
+                # are an AND of the path tags' bitmaps, rarest first so an
+                # empty intersection is found early
+                bits, names, tagged = self._tag_bitmaps()
+                path_bits = sorted((bits.get(self._tag_ids[t], 0) for t in tags), key=bit_count)
+                matches = -1
+                for b in path_bits:
+                    matches &= b
+                    if not matches:
+                        break
+                if not matches:
+                    logging.debug("no file carries every path tag")
+                    dirents.extend(('.' + t, dir_attrs, 0) for t in self._tag_ids.keys() - tset)
+                else:
+                    # matches carrying any tag beyond the path are hidden, and
+                    # other tags are shown when some match carries them.  Both
+                    # come from the matches' own tags, which is far less work
+                    # than testing every tag against the matches.
+                    file_ents = []
+                    touched = set()
+                    while matches:
+                        low = matches & -matches
+                        i = low.bit_length() - 1
+                        touched.update(tagged[i])
+                        file_ents.append(self._file_entry(names[i], len(tagged[i]) != len(tset)))
+                        matches ^= low
+                    tag_ents = [(tag if tag_id in touched else '.' + tag, dir_attrs, 0)
+                                for tag, tag_id in self._tag_ids.items() if tag not in tset]
+                    logging.info("file ents: %s", file_ents)
+                    logging.info("tag ents: %s", tag_ents)
+                    dirents.extend(file_ents)
+                    dirents.extend(tag_ents)
+            if len(self._listings) >= PATH_CACHE_SIZE:
+                self._listings.clear()
+            self._listings[path] = dirents
+
         logging.debug('finished making dir listing')
-        for r in dirents:
-            logging.debug(str(r))
-        for r in dirents:
-            yield r
+        if logging.root.isEnabledFor(logging.DEBUG):
+            for r in dirents:
+                logging.debug("%s", r[0])
+        return dirents
 
     def readlink(self, path):
-        logging.info("API: readlink " + path)
+        logging.info("API: readlink %s", path)
         read_dir = os.path.join(self.mount, '/'.join(file_tags(path)))
-        logging.debug("raw link: " + os.readlink(self._store_path(path)))
-        logging.debug("read dir: " + read_dir)
         path_from_store = os.readlink(self._store_path(path))
+        logging.debug("raw link: %s", path_from_store)
+        logging.debug("read dir: %s", read_dir)
         if path_from_store[0] == '/':
             pathname = path_from_store
         else:
             pathname = os.path.join(os.path.relpath(self.store, read_dir),
                                     path_from_store)
             pathname = os.path.normpath(pathname)
-        logging.debug("pathname: " + pathname)
+        logging.debug("pathname: %s", pathname)
         return pathname
 
     def mknod(self, path, mode, dev):
-        logging.info("API: mknod " + path)
+        logging.info("API: mknod %s", path)
         '''Generates a normal file (not folder-tag).
         Uses the path to set initial tags.'''
 
-        name = file_name(path)
-        if con.execute("SELECT 1 FROM files WHERE name = ?", (name,)).fetchone():
+        tags, name = parse_file_path(path)
+        if name in self._file_names:
             # possibly odd behavior to not overwrite, might need to be changed
             raise FuseOSError(errno.EEXIST)
-        for val in executemany("SELECT 1 FROM tags WHERE name = ?", tags):
-            if val is None:
-                raise FuseOSError(errno.ENOENT)
-        tags = file_tags(path)
-        with self.con as c:
-            c.execute("INSERT INTO files (name) VALUES ('?')", (name,))
-            file_id = c.lastrowid
-            self.con.executemany("INSERT INTO file_tags (file_id, tag_id) SELECT '?',id FROM tags WHERE name = ?",
-                                 ((file_id, tag) for tag in tags))
+        with self._transaction() as c:
+            file_id = c.execute("INSERT INTO files (name) VALUES (?)", (name,)).lastrowid
+            self._add_tags(c, file_id, tags)
             retval = os.mknod(self._store_path(path), mode, dev)
+            self._file_names.add(name)
+            if stat.S_IFMT(mode) not in (0, stat.S_IFREG):
+                self._file_types[name] = stat.S_IFMT(mode)
         return retval
 
     def mkdir(self, path, mode):
-        logging.info("API: mkdir " + path)
+        logging.info("API: mkdir %s", path)
         '''Create a new tag.'''
         new_tag = dir_tags(path)[-1]
-        raw = path.split('/')
-        if raw[-1] == '':
-            raw.pop()
-        raw = raw[-1]
+        raw = path.rstrip('/').rpartition('/')[2]
         if raw[0] == 0:
             raise FuseOSError(errno.EPERM)
-        if self.con.execute("SELECT 1 FROM tags WHERE name = ?", (new_tag,)).fetchone():
-            raise FuseOSError(errno.EEXIST)
-        with self.con as c:
-            c.execute("INSERT INTO tags (name) VALUES (?)", (new_tag,))
+        with self._transaction() as c:
+            if new_tag in self._tag_ids:
+                raise FuseOSError(errno.EEXIST)
+            self._tag_ids[new_tag] = c.execute("INSERT INTO tags (name) VALUES (?)", (new_tag,)).lastrowid
 
     def rmdir(self, path):
         '''Deletes an empty tag.'''
-        logging.info("API: rmdir " + path)
+        logging.info("API: rmdir %s", path)
         tag = dir_tags(path)[-1]
 
-        with self.con as c:
-            if c.execute("SELECT 1 FROM tags WHERE name = ?", (tag,)).fetchone() is None:
+        with self._transaction() as c:
+            if tag not in self._tag_ids:
                 raise FuseOSError(errno.ENOENT)
             #if c.execute("SELECT 1 FROM tags t INNER JOIN file_tags d ON t.id = d.tag_id").fetchone() is not None:
             if (x := c.execute("SELECT 1 FROM taggings WHERE tag = ?",
                               (tag,)).fetchone()) is not None:
-                logging.debug("tag contains: " + str(x))
+                logging.debug("tag contains: %s", x)
                 raise FuseOSError(errno.ENOTEMPTY)
             c.execute("DELETE FROM tags WHERE name = ?", (tag,))
+            del self._tag_ids[tag]
 
     def statfs(self, path):
-        logging.info("API: statfs " + path)
+        logging.info("API: statfs %s", path)
         # does this break on directories?
         full_path = self._store_path(path)
         stv = os.statvfs(full_path)
@@ -320,58 +587,59 @@ WHERE path_tag_count.count = ? )""" # , tags + tags + [len(tags)])
             'f_frsize', 'f_namemax'))
 
     def unlink(self, path):
-        logging.info("API: unlink " + path)
+        logging.info("API: unlink %s", path)
         store_path = self._store_path(path)
-        name = file_name(path)
-        if len(tags := file_tags(path)) != 0 and self.flat_delete:
-            self.con.execute("""DELETE FROM file_tags WHERE
-            tag_id = (SELECT id FROM tags WHERE name = ?) AND
-            file_id = (SELECT id FROM files WHERE name = ?)""",
-                             (tags[-1], name))
+        tags, name = parse_file_path(path)
+        if len(tags) != 0 and self.flat_delete:
+            with self._transaction() as c:
+                c.execute("""DELETE FROM file_tags WHERE
+                tag_id = (SELECT id FROM tags WHERE name = ?) AND
+                file_id = (SELECT id FROM files WHERE name = ?)""",
+                          (tags[-1], name))
             return
-        with self.con as c:
+        with self._transaction() as c:
             c.execute("""DELETE FROM file_tags WHERE
             file_id = (SELECT id FROM files WHERE name = ?)""", (name,))
             c.execute("DELETE FROM files WHERE name = ?", (name,))
             os.unlink(store_path)
+            self._forget_attrs(store_path)
+            self._file_names.discard(name)
+            self._file_types.pop(name, None)
 
     def symlink(self, name, target):
         '''Creates a symlink.  You shouldn't need as many inside this filesystem.'''
-        logging.info("API: symlink " + name + " to " + target)
+        logging.info("API: symlink %s to %s", name, target)
         # make a stripped name symlink in the store
         # errors here if there's something wrong with making that symlink
         if target[0] != '/':
             target = os.path.join(os.path.relpath(self.mount, self.store),
                                   target)
         # add the tags we need
-        tags = file_tags(name)
-        name = file_name(name)
-        with self.con as c:
+        tags, name = parse_file_path(name)
+        with self._transaction() as c:
             c = c.cursor()
             c.execute("INSERT INTO files (name) VALUES (?)", (name,))
             file_id = c.lastrowid
-            c.executemany("""INSERT INTO file_tags (file_id, tag_id)
-            SELECT ?, id FROM tags WHERE name = ?""",
-                          ((file_id, tag) for tag in tags))
+            self._add_tags(c, file_id, tags)
             retval = os.symlink(target, self._store_path(name))
+            self._file_names.add(name)
+            self._file_types[name] = stat.S_IFLNK
         return retval
 
     def rename(self, old, new):
         '''Changes the tag lists of a file, the name of a file, or the title of a tag.'''
-        logging.info("API: rename " + old + " to " + new)
-        old_name = file_name(old)
-        new_name = file_name(new)
+        logging.info("API: rename %s to %s", old, new)
+        from_tags, old_name = parse_file_path(old)
+        to_tags, new_name = parse_file_path(new)
         # are we dealing with a file or a folder?
-        with self.con as c:
-            if old[-1] == '/' or c.execute("SELECT 1 FROM files WHERE name = ?", (old_name,)).fetchone() is None:
+        with self._transaction() as c:
+            if old[-1] == '/' or old_name not in self._file_names:
                 # we are dealing with a (potentially bad) directory
                 logging.debug("renaming as directory")
                 old_tags = dir_tags(old)
                 new_tags = dir_tags(new)
-                old_tag_count = c.execute("SELECT count(name) FROM tags WHERE name IN (" +
-                                          ", ".join(["?"]*len(old_tags)) + ")", old_tags).fetchall()
-                logging.debug("old_tag_count: " + str(old_tag_count) + ", given old tags: " + str(old_tags))
-                if old_tag_count[0][0] < len(old_tags):
+                logging.debug("given old tags: %s", old_tags)
+                if not set(old_tags) <= self._tag_ids.keys():
                     raise FuseOSError(errno.ENOENT)
                 # if someone adds extra dirs after the one they want to change, that's not covered
                 for t_old, t_new in zip(old_tags[:-1], new_tags[:-1]):
@@ -382,26 +650,24 @@ WHERE path_tag_count.count = ? )""" # , tags + tags + [len(tags)])
                 if len(old_tags) == 1 and new == "/..deleteme": # magic dir name to delete a tag from windows
                     self.rmdir(old)
                     return
-                if c.execute("SELECT 1 FROM tags WHERE name = ?", (new_tag,)).fetchone() is not None:
+                if new_tag in self._tag_ids:
                     raise FuseOSError(errno.EEXIST)
                 c.execute("UPDATE tags SET name = ? WHERE name = ?", (new_tag, old_tag))
+                self._tag_ids[new_tag] = self._tag_ids.pop(old_tag)
             else:
                 logging.debug("renaming as file")
                 # handle taglist change
-                if set(from_tags := file_tags(old)) != set(to_tags := file_tags(new)):
+                if set(from_tags) != set(to_tags):
                     if not self._consistent_file_path(old):
-                        logging.debug(path + " deemed inconsistent")
+                        logging.debug("%s deemed inconsistent", old)
                         raise FuseOSError(errno.ENOENT)
-                    if len(from_tags) == 0 or old.split('/')[-1][0] == ".": # add only
-                        c.executemany("""INSERT OR IGNORE INTO file_tags (file_id, tag_id)
-                        SELECT f.id, t.id FROM files AS f CROSS JOIN tags AS t
-                        WHERE f.name = ? AND t.name = ?""", ((old_name, tag) for tag in to_tags))
-                    else:
-                        c.execute("""DELETE FROM file_tags WHERE
-                        file_id = (SELECT id FROM files WHERE name = ?)""", (old_name,))
-                        c.executemany("""INSERT INTO file_tags (file_id, tag_id)
-                        SELECT f.id, t.id FROM files AS f CROSS JOIN tags AS t
-                        WHERE f.name = ? AND t.name = ?""", ((old_name, tag) for tag in to_tags))
+                    file_id = c.execute("SELECT id FROM files WHERE name = ?", (old_name,)).fetchone()[0]
+                    to_ids = [tag_id for _, tag_id in self._tag_rows(file_id, to_tags)]
+                    if len(from_tags) != 0 and old.rpartition('/')[2][0] != ".":
+                        # exact move: drop only the tags the file is leaving,
+                        # rather than every row just to insert most of them again
+                        c.execute(keep_tags_sql(len(to_ids)), (file_id, *to_ids))
+                    self._add_tags(c, file_id, to_tags)
 
                 # handle filename change
                 if old_name != new_name:
@@ -409,83 +675,104 @@ WHERE path_tag_count.count = ? )""" # , tags + tags + [len(tags)])
                     new_path = self._store_path(new)
                     c.execute("UPDATE files SET name = ? WHERE name = ?", (new_name, old_name))
                     os.rename(old_path, new_path)
-
-    def link(self, target, name):
-        logging.info("API: link " + target + " to " + name)
-        if not self._consistent_file_name(target):
-            logging.debug(path + " deemed inconsistent")
+                    self._forget_attrs(old_path)
+                    self._forget_attrs(new_path)
+                    self._file_names.discard(old_name)
+                    self._file_names.add(new_name)
+                    if old_name in self._file_types:
+                        self._file_types[new_name] = self._file_types.pop(old_name)
+
+    def link(self, name, target):
+        '''Adds the tags of the new path name to the existing file target.'''
+        logging.info("API: link %s to %s", name, target)
+        if not self._consistent_file_path(target):
+            logging.debug("%s deemed inconsistent", target)
             raise FuseOSError(errno.ENOENT)
-        if file_name(target) != file_name(name):
+        tags, link_name = parse_file_path(name)
+        if file_name(target) != link_name:
             raise FuseOSError(errno.EPERM)
-        with self.con as c:
-            for v in c.executemany("SELECT 1 FROM tags WHERE name = ?", ((x,) for x in file_tags(name))).fetchall():
-                if v is None:
-                    raise FuseOSError(errno.ENOENT)
-            c.executemany("""INSERT OR IGNORE INTO file_tags (file_id, tag_id)
-            SELECT f.id, t.id FROM files AS f CROSS JOIN tags AS t
-            WHERE f.name = ? AND t.name = ?""", ((file_name(name), tag) for tag in file_tags(name)))
-            
+        with self._transaction() as c:
+            row = c.execute("SELECT id FROM files WHERE name = ?", (link_name,)).fetchone()
+            if row is None:
+                raise FuseOSError(errno.ENOENT)
+            self._add_tags(c, row[0], tags)
 
     def utimens(self, path, times=None):
-        logging.info("API: utimens " + path)
-        return os.utime(self._store_path(path), times)
+        logging.info("API: utimens %s", path)
+        store_path = self._store_path(path)
+        try:
+            return os.utime(store_path, times)
+        finally:
+            self._forget_attrs(store_path)
 
     def open(self, path, flags):
-        logging.info("API: open " + path)
+        logging.info("API: open %s", path)
         store_path = self._store_path(path)
         handle = os.open(store_path, flags)
-        logging.debug("Handle: " + str(handle))
+        logging.debug("Handle: %d", handle)
         return handle
 
     def create(self, path, mode):
-        logging.info("API: create " + path)
+        logging.info("API: create %s", path)
         store_path = self._store_path(path)
-        tags = file_tags(path)
-        name = file_name(path)
+        tags, name = parse_file_path(path)
 
-        with self.con as c:
+        with self._transaction() as c:
             cur = c.cursor()
             cur.execute("INSERT INTO files (name) VALUES (?)", (name,))
             id = cur.lastrowid
-            logging.debug("RowID: " + str(id))
-            cur.executemany("""INSERT INTO file_tags (file_id, tag_id)
-            SELECT ?,id FROM tags WHERE name = ?""",
-                          ((id, tag) for tag in tags))
+            logging.debug("RowID: %d", id)
+            self._add_tags(cur, id, tags)
             handle = os.open(store_path, os.O_WRONLY | os.O_CREAT, mode)
+            self._file_names.add(name)
         return handle
 
     def read(self, path, length, offset, fh):
-        logging.info("API: read " + path)
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.read(fh, length)
+        logging.info("API: read %s", path)
+        # positioned I/O, since threads may share a handle
+        return os.pread(fh, length, offset)
 
     def write(self, path, buf, offset, fh):
-        logging.info("API: write to " + path)
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.write(fh, buf)
+        logging.info("API: write to %s", path)
+        try:
+            return os.pwrite(fh, buf, offset)
+        finally:
+            self._forget_attrs(self._store_path(path))
 
     def truncate(self, path, length, fh=None):
-        logging.info("API: truncate " + path + ", len: " + str(length))
+        logging.info("API: truncate %s, len: %d", path, length)
         full_path = self._store_path(path)
-        with open(full_path, 'r+') as f:
-            f.truncate(length)
+        if fh is not None:
+            os.ftruncate(fh, length)
+        else:
+            os.truncate(full_path, length)
+        self._forget_attrs(full_path)
 
     def flush(self, path, fh):
-        logging.info("API: flush " + path)
-        return os.fsync(fh)
+        logging.info("API: flush %s", path)
+        return sync_data(fh)
 
     def release(self, path, fh):
-        logging.info("API: release " + path)
+        logging.info("API: release %s", path)
         return os.close(fh)
 
     def fsync(self, path, fdatasync, fh):
-        logging.info("API: fsync " + path)
-        return self.flush(path, fh)
+        logging.info("API: fsync %s", path)
+        self._commit()
+        if fdatasync:
+            return sync_data(fh)
+        return os.fsync(fh)
+
+    def destroy(self, path):
+        logging.info("API: destroy %s", path)
+        self._commit()
+        self.con.close()
 
 
 def main(mountpoint, root, options, flat_delete, limit):
-    logging.info("Mountpoint: "+ str(mountpoint)+ ", root: "+ str(root))
-    FUSE(Tagfs(root, mountpoint, flat_delete, limit), mountpoint, nothreads=True, foreground=True, **options)
+    logging.info("Mountpoint: %s, root: %s", mountpoint, root)
+    options = dict(DEFAULT_FUSE_OPTIONS, **options)
+    FUSE(Tagfs(root, mountpoint, flat_delete, limit), mountpoint, foreground=True, **options)
 
 if __name__ == '__main__':
     parser = OptionParser()
@@ -503,12 +790,16 @@ if __name__ == '__main__':
                       help="allow deletion anywhere, instead of just in the root of the fileystem")
     parser.add_option("-l", "--limit", dest="limit", type="int", default=-1,
                       help="set a limit to the number of hidden files to list in the root of the mount")
+    parser.add_option("--attr-timeout", dest="attr_timeout", type="float",
+                      help="seconds the kernel may cache file attributes (default %s)" % DEFAULT_FUSE_OPTIONS['attr_timeout'])
+    parser.add_option("--entry-timeout", dest="entry_timeout", type="float",
+                      help="seconds the kernel may cache name lookups (default 1)")
     options, args = parser.parse_args()
     if options.verbosity > 0:
         logging.root.setLevel(logging.INFO)
         if options.verbosity > 1:
             logging.root.setLevel(logging.DEBUG)
-        logging.info("Verbosity: "+ str(options.verbosity))
+        logging.info("Verbosity: %d", options.verbosity)
     if options.silent:
         class DevNull:
             def write(self, msg):
@@ -517,8 +808,15 @@ if __name__ == '__main__':
         sys.tracebacklimit = 0
 
     if options.fuse_options is not None:
-        kwargs = {opt: True for opt in options.fuse_options.split(",")}
-        logging.info("FS options: " + str(kwargs))
+        # valued options like attr_timeout=1 are passed through as given
+        kwargs = {}
+        for opt in options.fuse_options.split(","):
+            key, sep, value = opt.partition("=")
+            kwargs[key] = value if sep else True
+        logging.info("FS options: %s", kwargs)
     else:
         kwargs = {}
+    for key in ('attr_timeout', 'entry_timeout'):
+        if getattr(options, key) is not None:
+            kwargs[key] = getattr(options, key)
     main(options.mountpoint, options.datastore, kwargs, options.flat_delete, options.limit)
@@ -0,0 +1,43 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from fuse import FuseOSError
+
+import pytagfs
+
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.mount = tempfile.mkdtemp()
+        self.fs = pytagfs.Tagfs(self.root, self.mount, True, -1)
+
+    def tearDown(self):
+        self.fs.destroy('/')
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.mount)
+
+    def test_failed_change_ends_transaction(self):
+        with self.assertRaises(FuseOSError):
+            self.fs.create('/nosuchtag/f', 0o644)
+        self.assertFalse(self.fs.con.in_transaction)
+        # so other connections can write straight away
+        other = sqlite3.connect(os.path.join(self.root, '.sqlite'), timeout=0)
+        with other:
+            other.execute("INSERT INTO tags (name) VALUES ('other')")
+        other.close()
+
+    def test_failed_change_keeps_pending_changes(self):
+        os.close(self.fs.create('/f', 0o644))
+        with self.assertRaises(FuseOSError):
+            self.fs.create('/nosuchtag/g', 0o644)
+        self.assertTrue(self.fs.con.in_transaction)
+        self.fs._commit()
+        self.assertEqual(self.fs._files(), ['f'])
+
+
+if __name__ == '__main__':
+    unittest.main()